@@ -2,30 +2,94 @@ import pandas as pd
 import numpy as np
 from PIL import Image
 import streamlit as st
-import altair as alt
-from datetime import datetime
 import plotly.express as px
-from sodapy import Socrata
+import pydeck as pdk
+from urllib.parse import urlencode
+
+
+@st.cache_data(show_spinner=False)
+def load_communities():
+    """Loads the community names and their community area numbers."""
+
+    return pd.read_csv("data_files/communities.csv")
 
 
 # Import the community data files.
-df_communities = pd.read_csv("data_files/communities.csv")
+df_communities = load_communities()
+
+# Lookup from community name to its community area number.
+COMMUNITY_LOOKUP = dict(zip(df_communities['Community'], df_communities['Community Area']))
 
 # API access
 # Website: https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-Present/ijzp-q8t2/data_preview
-
+CRIME_API_URL = "https://data.cityofchicago.org/resource/ijzp-q8t2.csv"
+
+# Vega-Lite specs for the line and bar charts. They are built once here and handed to
+# st.vega_lite_chart with the aggregated data, so no Altair objects are validated on each rerun.
+LINE_CHART_SPEC = {
+    "usermeta": {"embedOptions": {"theme": "dark"}},
+    "mark": {"type": "line", "point": True},
+    "encoding": {
+        "x": {"field": "month", "type": "ordinal", "title": "Month"},
+        "y": {"field": "crime_count", "type": "quantitative", "title": "Number of Crimes"},
+        "tooltip": [{"field": "month", "type": "ordinal"},
+                    {"field": "crime_count", "type": "quantitative"}]
+    },
+    "width": 400,
+    "height": 300
+}
+
+ARREST_CHART_SPEC = {
+    "usermeta": {"embedOptions": {"theme": "dark"}},
+    "layer": [
+        {
+            "mark": {"type": "bar"},
+            "encoding": {
+                "x": {"field": "arrest", "type": "nominal", "title": "Arrest Made"},
+                "y": {"field": "count", "type": "quantitative", "title": "Counts"},
+                "color": {"field": "arrest", "type": "nominal", "title": "Arrest Made"},
+                "tooltip": [{"field": "arrest", "type": "nominal"},
+                            {"field": "count", "type": "quantitative"},
+                            {"field": "percentage", "type": "quantitative"}]
+            }
+        },
+        {
+            # Text labels for percentages
+            "mark": {"type": "text", "dy": -10, "fontSize": 14, "color": "black"},
+            "encoding": {
+                "x": {"field": "arrest", "type": "nominal"},
+                "y": {"field": "ratio", "type": "quantitative"},
+                "text": {"field": "percentage", "type": "quantitative", "format": ".1f"}
+            }
+        }
+    ],
+    "width": 400,
+    "height": 300
+}
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def call_data(start_date, end_date, crime_type, community):
-    """Makes a call to the chicago crime API. """
+    """Makes a call to the chicago crime API for the chosen date window. """
+
+    query = urlencode({
+        "$select": "id, case_number, block, primary_type, description, location_description, arrest, date, community_area, fbi_code,"
+                   "year, latitude, longitude",
+        "$where": f"date >= '{start_date}T00:00:00.000' AND date < '{end_date}T00:00:00.000' "
+                  f"AND primary_type = '{crime_type}' AND community_area = '{community}'",
+        "$order": "date DESC",
+        "$limit": 250000,
+    })
 
-    client = Socrata("data.cityofchicago.org", None)
-    results = client.get("ijzp-q8t2",
-                         select="id, case_number, block, primary_type, description, location_description, arrest, date, community_area, fbi_code,"
-                                "year, latitude, longitude",
-                         where=f"date > '{start_date}' AND date < '{end_date}' AND primary_type = '{crime_type}' AND community_area = '{community}'",
-                         limit=250000,
-                         order="date DESC")
+    # Read the CSV export directly with the pyarrow engine instead of building a dict per row.
+    # pyarrow parses the columns in parallel, including the ISO-8601 dates, so they arrive as datetime64.
+    # Repeated labels are read as categories and coordinates as float32 to keep the frame small.
+    df_crime = pd.read_csv(f"{CRIME_API_URL}?{query}", engine='pyarrow',
+                           dtype={'community_area': 'category', 'primary_type': 'category',
+                                  'location_description': 'category', 'fbi_code': 'category',
+                                  'latitude': np.float32, 'longitude': np.float32, 'arrest': 'bool'},
+                           parse_dates=['date'])
 
-    return results
+    return df_crime
 
 
 def crime_names():
@@ -41,21 +105,25 @@ def crime_names():
     return df_crime_type
 
 
-def convert_community(chosen_community, df_communities):
+def convert_community(chosen_community):
     """Converts the chosen community to a number that can be called in the API."""
 
-    community_row = df_communities[df_communities['Community'] == chosen_community]
-    community_area_number = community_row.iloc[0]['Community Area']
+    return COMMUNITY_LOOKUP[chosen_community]
 
-    return community_area_number
 
+@st.cache_data(ttl=3600)
+def clean_crimes(crime, community, start_date= "2018-01-01", end_date="2024-01-01"):
+    """Combines the crime, demographic and neightborhoods dataframe into one.
 
-@st.cache_data
-def clean_crimes(crime_df, neighborhoods, crime, start_date= "2018-01-01", end_date="2024-01-01"):
-    """Combines the crime, demographic and neightborhoods dataframe into one."""
+    Only scalars are taken as arguments so the cache key stays cheap to hash; the crime and
+    community frames are loaded here through their own cached loaders.
+    """
+
+    crime_df = call_data(start_date, end_date, crime, community)
+    neighborhoods = load_communities()
 
-    # Convert 'Date' column to date time
-    crime_df['date'] = pd.to_datetime(crime_df['date'], format='mixed')
+    # Filter for only the crime of interest before any of the column work below.
+    crime_df = crime_df.loc[crime_df['primary_type'] == crime].copy()
 
     # Apply filter to dataframe
     mask_1 = crime_df['date'] >= start_date
@@ -69,157 +137,152 @@ def clean_crimes(crime_df, neighborhoods, crime, start_date= "2018-01-01", end_d
     crime_df['month'] = crime_df['date'].dt.month
     crime_df['year'] = crime_df['date'].dt.year
 
-    # Create a feature based on time of day
-    conditions = [
-        (crime_df['hour'] >= 0) & (crime_df['hour'] < 4),
-        (crime_df['hour'] >= 4) & (crime_df['hour'] < 8),
-        (crime_df['hour'] >= 8) & (crime_df['hour'] < 12),
-        (crime_df['hour'] >= 12) & (crime_df['hour'] < 16),
-        (crime_df['hour'] >= 16) & (crime_df['hour'] < 20),
-        (crime_df['hour'] >= 20)
-    ]
-
+    # Create a feature based on time of day. Each bucket is four hours wide, so the
+    # bucket index is just the hour divided by four.
     values = ['12am to 4am', '4am to 8am', '8am to 12pm', '12pm to 4pm', '4pm to 8pm',
               '8pm to 12am']
 
-    crime_df['Time of Day'] = np.select(conditions, values)
-
-    # Filter for only the crime of interest.
-    crime_df = crime_df.loc[crime_df['primary_type'] == crime]
+    # Write the bucket codes straight into an int8 array instead of shifting into a
+    # full-width array and casting it afterwards.
+    codes = np.empty(len(crime_df), dtype=np.int8)
+    np.right_shift(crime_df['hour'].to_numpy(), 2, out=codes)
+    crime_df['Time of Day'] = pd.Categorical.from_codes(codes, categories=values)
 
     # Rename the column Community in the Commnities dataframe
     neighborhoods = neighborhoods.rename(columns={"Community Area": "community_area"})
 
-    # Make the community_area a string in neightborhoods.
-    neighborhoods['community_area'] = neighborhoods['community_area'].astype(str)
-
-    # Add the communities to the dataframe.
-    crime_df_1 = pd.merge(crime_df, neighborhoods, on='community_area', how='outer')
+    # Make the community_area a categorical in neightborhoods and share its dtype with the crimes,
+    # so the merge joins on the integer codes. Both sides hold the area as an integer.
+    neighborhoods['community_area'] = neighborhoods['community_area'].astype('category')
+    crime_df['community_area'] = crime_df['community_area'].astype(neighborhoods['community_area'].dtype)
 
-    # Remove NA columns where id = NaN.  This is from the discrepancy between the current date and the
-    # chosen end date.
-    crime_df_2 = crime_df_1.dropna(subset="id")
+    # Add the communities to the dataframe. A left join keeps only the rows that have a crime.
+    crime_df_1 = pd.merge(crime_df, neighborhoods, on='community_area', how='left')
 
     # Obtain the total number of crimes
-    crime_total = len(crime_df_2)
+    crime_total = len(crime_df_1)
 
-    return crime_df_2, crime_total
+    return crime_df_1, crime_total
 
-def plot_crime_time_series(df):
+@st.cache_data
+def compute_all_counts(df):
     """
-    Plots a line chart of recorded crimes annually from the cleaned data.
+    Counts the crimes once for every column the charts group by.
 
     Args:
-        df (pd.DataFrame): Cleaned crime data with 'year' column.
+        df (pd.DataFrame): Cleaned crime data.
 
     Returns:
-        alt.Chart: An Altair line chart.
+        dict: Column name mapped to its value_counts series.
     """
-    # Group data by year and count crimes per year
-    annual_crime_counts = df.groupby("month").size().reset_index(name="crime_count")
-
-    # Create a line chart
-    line_chart = (
-        alt.Chart(annual_crime_counts)
-        .mark_line(point=True)
-        .encode(
-            x=alt.X("month:O", title="Month"),
-            y=alt.Y("crime_count:Q", title="Number of Crimes"),
-            tooltip=["month", "crime_count"]
-        )
-        .properties(width=400, height=300)
-    )
+    return {col: df[col].value_counts() for col in ('month', 'arrest', 'Time of Day', 'location_description')}
+
+def monthly_crime_counts(counts):
+    """
+    Counts the recorded crimes per month for the line chart.
+
+    Args:
+        counts (dict): Output of compute_all_counts with a 'month' entry.
+
+    Returns:
+        pd.DataFrame: Monthly crime counts to draw with LINE_CHART_SPEC.
+    """
+    # Put the monthly counts in calendar order
+    annual_crime_counts = counts['month'].sort_index().rename_axis('month').reset_index(name="crime_count")
 
-    return line_chart
+    return annual_crime_counts
 
-def plot_arrest_ratio(df):
+def arrest_ratio_counts(counts):
     """
-    Plots a bar chart showing the ratio of crimes resulting in an arrest.
+    Counts the crimes resulting in an arrest for the bar chart.
 
     Args:
-        df (pd.DataFrame): Cleaned crime data with 'arrest' column.
+        counts (dict): Output of compute_all_counts with an 'arrest' entry.
 
     Returns:
-        alt.Chart: An Altair bar chart.
+        pd.DataFrame: Arrest counts and percentages to draw with ARREST_CHART_SPEC.
     """
     # Calculate the total and arrested counts
-    arrest_counts = df['arrest'].value_counts().reset_index()
+    arrest_counts = counts['arrest'].reset_index()
     arrest_counts.columns = ['arrest', 'count']
 
     # Calculate the ratio
     arrest_counts['ratio'] = arrest_counts['count'] / arrest_counts['count'].sum()
     arrest_counts['percentage'] = (arrest_counts['ratio'] * 100).round(2)
 
-    # Bar chart
-    bars = (
-        alt.Chart(arrest_counts)
-        .mark_bar()
-        .encode(
-            x=alt.X("arrest:N", title="Arrest Made"),
-            y=alt.Y("count:Q", title="Counts"),
-            color=alt.Color("arrest:N", title="Arrest Made"),
-            tooltip=["arrest", "count", "percentage"]
-        )
-    )
-
-    # Text labels for percentages
-    text = (
-        alt.Chart(arrest_counts)
-        .mark_text(dy=-10, fontSize=14, color="black")
-        .encode(
-            x=alt.X("arrest:N"),
-            y=alt.Y("ratio:Q"),
-            text=alt.Text("percentage:Q", format=".1f")
-        )
-    )
-
-    chart = (bars + text).properties(width=400, height=300)
-    return chart
+    return arrest_counts
 
-def plot_community_time_day(df):
+def plot_community_time_day(counts):
     """Determines and plots the number of crimes in the community by the time of day."""
 
     # Order for the x_axis
     order = ['12am to 4am', '4am to 8am', '8am to 12pm', '12pm to 4pm', '4pm to 8pm', '8pm to 12am']
 
+    # Count the crimes by time of day, keeping empty buckets so every bar is shown.
+    time_counts = counts['Time of Day'].reindex(order, fill_value=0).rename_axis('Time of Day').reset_index(name='count')
+
     # Plot the crimes by time of day
-    fig = px.histogram(df, x='Time of Day', category_orders={'Time of Day': order})
+    fig = px.bar(time_counts, x='Time of Day', y='count', category_orders={'Time of Day': order})
     # Set the pie chart size.
     fig.update_layout(width=400, height=350)
 
     return fig
 
-def location_description(df):
+def location_description(counts):
     """Plots a histogram of the location of most likely occurrence."""
 
-    value_counts = df['location_description'].value_counts()
+    location_counts = counts['location_description'].rename_axis('location_description').reset_index(name='count')
 
-    # Does a breakdown of occurrence for each crime.
-    fig = px.pie(df, values=value_counts.values, names=value_counts.index)
+    # Does a breakdown of occurrence for each crime from the aggregated counts only.
+    fig = px.pie(location_counts, values='count', names='location_description')
     fig.update_layout(width=450, height=400)
     # Removes the labels
     fig.update_traces(textposition='inside', textinfo='none')
 
     return fig
 
+@st.cache_data
 def crime_map(df):
-    """Plots a map of the different crime locations"""
-
-    latitude = df['latitude']
-    longitude = df['longitude']
-    coordinates_data = {'latitude': latitude, 'longitude': longitude}
-    df_coordinates = pd.DataFrame(coordinates_data)
-
-    df_coordinates['latitude'] = df_coordinates['latitude'].astype(float)
-    df_coordinates['longitude'] = df_coordinates['longitude'].astype(float)
-
-    # drop any NaN values
-    df_coordinates = df_coordinates.dropna()
+    """Bins the crime locations into a grid of roughly 200m cells with a count per cell."""
+
+    # The coordinates are already float32 from call_data, so just drop any NaN values
+    df_coordinates = df[['latitude', 'longitude']].dropna()
+
+    # Snap each point to a 1/500 degree grid so the browser only draws one point per cell.
+    df_bins = (
+        df_coordinates
+        .assign(lat=lambda d: (d.latitude * 500).round() / 500,
+                lon=lambda d: (d.longitude * 500).round() / 500)
+        .groupby(['lat', 'lon'])
+        .size()
+        .reset_index(name='n')
+    )
 
-    color = '#4dffff'
-    size = 25
+    return df_bins
+
+def plot_crime_map(df_bins):
+    """Plots a hexagon map of the binned crime locations."""
+
+    # Center the view on the crimes, or on Chicago when there are none.
+    center = df_bins[['lat', 'lon']].mean().fillna({'lat': 41.8781, 'lon': -87.6298})
+
+    layer = pdk.Layer(
+        "HexagonLayer",
+        df_bins,
+        get_position='[lon, lat]',
+        get_elevation_weight='n',
+        elevation_aggregation='SUM',
+        get_color_weight='n',
+        color_aggregation='SUM',
+        elevation_scale=50,
+        radius=100,
+        extruded=True,
+        pickable=True
+    )
+    # pydeck's JSON encoder only handles Python floats, not the float32 coordinates.
+    view_state = pdk.ViewState(latitude=float(center['lat']), longitude=float(center['lon']), zoom=12, pitch=45)
 
-    return df_coordinates, color, size
+    return pdk.Deck(layers=[layer], initial_view_state=view_state)
 
 
 
@@ -230,8 +293,6 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-alt.themes.enable("dark")
-
 # Provide initial start and end times for the date inputs.
 start_init = "2023-01-01"
 end_init = "2024-01-01"
@@ -263,18 +324,7 @@ with st.sidebar:
     )
     
 
-community_chosen_1 = convert_community(community_chosen, df_communities)
-
-# Query the current date
-starting_date = "2018-01-01T00:00:00.000"
-current_date = datetime.now()
-end_date = current_date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-end_date_2 = f"{end_date}"
-
-
-# Obtain the data from the chicago crime API.
-results = call_data(starting_date, end_date_2, crime_type, community_chosen_1)
-df_crime_1 = pd.DataFrame.from_records(results)
+community_chosen_1 = convert_community(community_chosen)
 
 # Convert the datetime to a string
 begin_date_1 = begin_date.strftime('%Y-%m-%d')
@@ -292,34 +342,42 @@ crimecount_placeholder = st.empty()
 st.subheader('Table of Data')
 # Placeholder for dataframe table
 data_placeholder = st.empty()
-# Clean the data and create the Time of Day column
-new_df, crime_tot = clean_crimes(df_crime_1, df_communities, crime_type, begin_date_1, ending_date_1)
-if 'new_df_key_1' not in st.session_state:
+# Clean the data and create the Time of Day column. This only runs on the first load and when
+# "Update Data" is clicked; other widget changes reuse the session state.
+if data_button or 'new_df_key_1' not in st.session_state:
+    new_df, crime_tot = clean_crimes(crime_type, community_chosen_1, begin_date_1, ending_date_1)
     # Add the new dataframe to the current session state.
     st.session_state['new_df_key_1'] = new_df
-    data_placeholder = st.empty()
-    data_placeholder.dataframe(new_df)
-    # Count of Total Crimes and update the value
-    crimecount_placeholder.subheader(crime_tot)
+    st.session_state['crime_tot_key_1'] = crime_tot
+
+# Every element below is drawn exactly once per rerun from this frame.
+current_df = st.session_state['new_df_key_1']
+
+data_placeholder.dataframe(current_df)
+# Count of Total Crimes and update the value
+crimecount_placeholder.subheader(st.session_state['crime_tot_key_1'])
 
 st.text("")
 st.text("")
 
+# Count the crimes for every chart in one cached pass.
+crime_counts = compute_all_counts(current_df)
+
 # Rows to hold the pie and bar charts.
 col1, col2 = st.columns(2)
 with col1:
     # Line Plot
     st.subheader('Monthly Crimes Trends')
     lineplot_placeholder = st.empty()
-    fig = plot_crime_time_series(st.session_state['new_df_key_1'])
-    lineplot_placeholder.altair_chart(fig)
+    annual_crime_counts = monthly_crime_counts(crime_counts)
+    lineplot_placeholder.vega_lite_chart(annual_crime_counts, LINE_CHART_SPEC)
 
 with col2:
     # Bar Chart
     st.subheader('Arrest Ratio')
     bar_chart_placeholder = st.empty()
-    fig = plot_arrest_ratio(st.session_state['new_df_key_1'])
-    bar_chart_placeholder.altair_chart(fig)
+    arrest_counts = arrest_ratio_counts(crime_counts)
+    bar_chart_placeholder.vega_lite_chart(arrest_counts, ARREST_CHART_SPEC)
 
 # Rows to hold the pie and bar charts.
 col1, col2 = st.columns(2)
@@ -327,14 +385,14 @@ with col1:
     # Box Plot
     st.subheader('Time of Day')
     boxplot_placeholder = st.empty()
-    fig = plot_community_time_day(st.session_state['new_df_key_1'])
+    fig = plot_community_time_day(crime_counts)
     boxplot_placeholder.plotly_chart(fig)
 
     #Pie chart
 with col2:
     st.subheader('Location Description')
     piechart_placeholder = st.empty()
-    fig2 = location_description(st.session_state['new_df_key_1'])
+    fig2 = location_description(crime_counts)
     piechart_placeholder.plotly_chart(fig2)
 
 
@@ -343,27 +401,5 @@ st.text("")
     # Location Map
 create_map = st.empty()
 create_map.subheader("Crime Location Map")
-df_coordinates, color, size = crime_map(st.session_state['new_df_key_1'])
-create_map.map(df_coordinates, color=color, size=size)
-
-
-
-# Load the data and update the placeholders when "Update Data" is clicked.
-if data_button:
-    crimecount_placeholder.subheader(crime_tot)
-
-    new_df, crime_tot = clean_crimes(df_crime_1, df_communities, crime_type, begin_date_1, ending_date_1)
-    st.session_state['new_df_key_1'] = new_df
-    data_placeholder.dataframe(new_df)
-
-    # Boxplot implementation
-    fig = plot_community_time_day(st.session_state['new_df_key_1'])
-    boxplot_placeholder.plotly_chart(fig)
-
-    # Piechart implementation
-    fig2 = location_description(st.session_state['new_df_key_1'])
-    piechart_placeholder.plotly_chart(fig2)
-
-    # Map implementation
-    df_coordinates, color, size = crime_map(st.session_state['new_df_key_1'])
-    create_map.map(df_coordinates, color=color, size=size)
+df_bins = crime_map(current_df)
+create_map.pydeck_chart(plot_crime_map(df_bins))